@@ -4,14 +4,74 @@ from bluebees.client.node.node_data import NodeData
 from bluebees.client.data_paths import base_dir, net_dir, node_dir
 from bluebees.common.logging import log_sys, INFO, DEBUG
 from bluebees.common.crypto import crypto
-from bluebees.common.file import file_helper
+from functools import lru_cache
 import asyncio
+import os
+import struct
+
+_pack_u8 = struct.Struct('>B').pack
+_unpack_u32 = struct.Struct('>I').unpack_from
+
+
+@lru_cache(maxsize=64)
+def _security_material_for_key(key: bytes) -> (int, bytes, bytes):
+    materials = crypto.k2(n=key, p=b'\x00')
+    nid = materials[0] & 0x7f
+    encryption_key = materials[1:17]
+    privacy_key = materials[17:33]
+    return nid, encryption_key, privacy_key
+
+
+def _dir_mtime(dirpath: str) -> int:
+    try:
+        return os.stat(dirpath).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _yml_files(dirpath: str) -> list:
+    try:
+        with os.scandir(dirpath) as it:
+            return [e.path for e in it
+                    if e.name.endswith('.yml') and e.is_file()]
+    except FileNotFoundError:
+        return []
+
+
+@lru_cache(maxsize=64)
+def _iv_index_fragments(iv_index: bytes) -> (bytes, bytes):
+    # (network nonce suffix, PECB plaintext prefix)
+    return b'\x00\x00' + iv_index, b'\x00\x00\x00\x00\x00' + iv_index
+
+
+# filename -> (mtime, size, NetworkData)
+_netdata_cache = {}
+
+
+def _load_net_data(filename: str) -> NetworkData:
+    st = os.stat(filename)
+    entry = _netdata_cache.get(filename)
+    if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+        return entry[2]
+
+    net_data = NetworkData.load(filename)
+    _netdata_cache[filename] = (st.st_mtime_ns, st.st_size, net_data)
+    return net_data
 
 
 # ! The SEQ number is different for each node
 # ! Each new provisioned node send message with SEQ start with zero
 class NetworkLayer:
 
+    # nid -> NetworkData, rebuilt when the net dir changes. Only the key,
+    # iv_index and name are used here, and those are fixed once a network
+    # file is created
+    _nid_index = {}
+    _nid_index_mtime = None
+    # node addr -> node filename, rebuilt when the node dir changes
+    _addr_index = {}
+    _addr_index_mtime = None
+
     def __init__(self, send_queue, recv_queue):
         self.hard_ctx = HardContext(seq=0, ttl=2, is_ctrl_msg=True,
                                     seq_zero=0, seg_o=0, seg_n=0, szmic=0)
@@ -33,47 +93,41 @@ class NetworkLayer:
     # send methods
     def _gen_security_material(self,
                                net_data: NetworkData) -> (int, bytes, bytes):
-        materials = crypto.k2(n=net_data.key, p=b'\x00')
-        nid = materials[0] & 0x7f
-        encryption_key = materials[1:17]
-        privacy_key = materials[17:33]
-        return nid, encryption_key, privacy_key
+        return _security_material_for_key(net_data.key)
+
+    def _gen_net_nonce(self, ctl: int, ttl: int, seq: int, src: bytes,
+                       net_data: NetworkData) -> bytes:
+        # SEQ is 24 bits; to_bytes raises instead of wrapping into a nonce
+        # that was already used with this key
+        nonce_suffix, _ = _iv_index_fragments(net_data.iv_index)
+        return b''.join((b'\x00', _pack_u8(ctl | ttl), seq.to_bytes(3, 'big'),
+                         src, nonce_suffix))
 
     def _encrypt(self, soft_ctx: SoftContext, transport_pdu: bytes,
                  encryption_key: bytes,
-                 net_nonce: bytes) -> (bytes, bytes, bytes):
+                 net_nonce: bytes) -> bytes:
+        # EncDST || EncTransportPDU || NetMIC, as one AES-CCM output
         mic_size = 8 if self.hard_ctx.is_ctrl_msg else 4
-        aes_ccm_result, mic = crypto.aes_ccm_complete(key=encryption_key,
-                                                      nonce=net_nonce,
-                                                      text=soft_ctx.dst_addr +
-                                                      transport_pdu,
-                                                      adata=b'',
-                                                      mic_size=mic_size)
-        enc_dst = aes_ccm_result[0:2]
-        encrypted_data = aes_ccm_result[2:]
-        net_mic = mic
-        return enc_dst, encrypted_data, net_mic
+        return crypto.aes_ccm_encrypt(key=encryption_key, nonce=net_nonce,
+                                      text=soft_ctx.dst_addr + transport_pdu,
+                                      adata=b'', mic_size=mic_size)
 
     def __xor(self, a: bytes, b: bytes):
-        c = b''
-        for x in range(len(a)):
-            c += int(a[x] ^ b[x]).to_bytes(1, 'big')
-        return c
+        return (int.from_bytes(a, 'big') ^
+                int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
 
-    def _obsfucate(self, ctl: int, ttl: int, seq: int, src: bytes,
-                   enc_dst: bytes, enc_transport_pdu: bytes, net_mic: bytes,
+    def _obsfucate(self, header: bytes, enc_payload: bytes,
                    privacy_key: bytes, net_data: NetworkData) -> bytes:
-        privacy_random = (enc_dst + enc_transport_pdu + net_mic)[0:7]
-        pecb = crypto.e(key=privacy_key, plaintext=b'\x00\x00\x00\x00\x00' +
-                                                   net_data.iv_index +
-                                                   privacy_random)
-        obsfucated_data = self.__xor((ctl | ttl).to_bytes(1, 'big') +
-                                     seq.to_bytes(3, 'big') + src, pecb[0:6])
+        # header is CTL/TTL || SEQ || SRC
+        privacy_random = enc_payload[0:7]
+        _, pecb_prefix = _iv_index_fragments(net_data.iv_index)
+        pecb = crypto.e(key=privacy_key, plaintext=pecb_prefix + privacy_random)
+        obsfucated_data = self.__xor(header, pecb)
         return obsfucated_data
 
     async def send_pdu(self, transport_pdu: bytes, soft_ctx: SoftContext):
-        net_data = NetworkData.load(base_dir + net_dir + soft_ctx.network_name
-                                    + '.yml')
+        net_data = _load_net_data(base_dir + net_dir + soft_ctx.network_name
+                                  + '.yml')
         node_data = NodeData.load(base_dir + node_dir + soft_ctx.node_name
                                   + '.yml')
         self.hard_ctx.seq = node_data.seq
@@ -81,67 +135,78 @@ class NetworkLayer:
         nid, encryption_key, privacy_key = \
             self._gen_security_material(net_data)
 
-        ivi = ((int.from_bytes(net_data.iv_index, 'big') & 0x01) << 7)
+        ivi = (_unpack_u32(net_data.iv_index)[0] & 0x01) << 7
         ctl = 0x80 if self.hard_ctx.is_ctrl_msg else 0x00
         ttl = 0x02
         seq = self.hard_ctx.seq
         src = soft_ctx.src_addr
 
-        net_nonce = b'\x00' + (ctl | ttl).to_bytes(1, 'big') + \
-            seq.to_bytes(3, 'big') + src + b'\x00\x00' + net_data.iv_index
+        net_nonce = self._gen_net_nonce(ctl, ttl, seq, src, net_data)
 
-        enc_dst, enc_transport_pdu, net_mic = self._encrypt(soft_ctx,
-                                                            transport_pdu,
-                                                            encryption_key,
-                                                            net_nonce)
+        enc_payload = self._encrypt(soft_ctx, transport_pdu, encryption_key,
+                                    net_nonce)
 
-        obsfucated = self._obsfucate(ctl, ttl, seq, src, enc_dst,
-                                     enc_transport_pdu, net_mic, privacy_key,
+        # the obfuscated header is the same CTL/TTL || SEQ || SRC that is
+        # already laid out in the nonce
+        obsfucated = self._obsfucate(net_nonce[1:7], enc_payload, privacy_key,
                                      net_data)
 
-        network_pdu = (ivi | nid).to_bytes(1, 'big') + obsfucated + enc_dst + \
-            enc_transport_pdu + net_mic
+        network_pdu = b''.join((_pack_u8(ivi | nid), obsfucated, enc_payload))
 
         await self.send_queue.put((b'message_s', network_pdu))
 
         self.__increment_seq(soft_ctx)
 
     # receive methods
-    def __search_network_by_nid(self, nid: int) -> NetworkData:
-        filenames = file_helper.list_files(base_dir + net_dir)
-
-        for f in filenames:
-            net_data = NetworkData.load(base_dir + net_dir + f)
+    def __update_nid_index(self):
+        mtime = _dir_mtime(base_dir + net_dir)
+        if mtime is not None and mtime == NetworkLayer._nid_index_mtime:
+            return
+
+        nid_index = {}
+        for filename in _yml_files(base_dir + net_dir):
+            net_data = _load_net_data(filename)
             net_nid, _, _ = self._gen_security_material(net_data)
-            if net_nid == nid:
-                return net_data
+            nid_index.setdefault(net_nid, net_data)
 
-        return None
+        NetworkLayer._nid_index = nid_index
+        NetworkLayer._nid_index_mtime = mtime
 
-    def __search_node_by_addr(self, addr: bytes) -> NodeData:
-        filenames = file_helper.list_files(base_dir + node_dir)
+    def __search_network_by_nid(self, nid: int) -> NetworkData:
+        self.__update_nid_index()
+        return NetworkLayer._nid_index.get(nid)
 
-        for f in filenames:
-            node_data = NodeData.load(base_dir + node_dir + f)
-            if addr == node_data.addr:
-                return node_data
+    def __update_addr_index(self):
+        mtime = _dir_mtime(base_dir + node_dir)
+        if mtime is not None and mtime == NetworkLayer._addr_index_mtime:
+            return
 
-        return None
+        addr_index = {}
+        for filename in _yml_files(base_dir + node_dir):
+            node_data = NodeData.load(filename)
+            addr_index.setdefault(node_data.addr, filename)
+
+        NetworkLayer._addr_index = addr_index
+        NetworkLayer._addr_index_mtime = mtime
+
+    def __search_node_file_by_addr(self, addr: bytes) -> str:
+        self.__update_addr_index()
+        return NetworkLayer._addr_index.get(addr)
 
     def _clean_message(self, net_pdu: bytes, net_data: NetworkData) -> bytes:
         _, _, privacy_key = self._gen_security_material(net_data)
         privacy_random = net_pdu[7:14]
         obsfucated_data = net_pdu[1:7]
-        pecb = crypto.e(key=privacy_key, plaintext=b'\x00\x00\x00\x00\x00' +
-                        net_data.iv_index + privacy_random)
-        clean_result = self.__xor(obsfucated_data, pecb[0:6])
+        _, pecb_prefix = _iv_index_fragments(net_data.iv_index)
+        pecb = crypto.e(key=privacy_key, plaintext=pecb_prefix + privacy_random)
+        clean_result = self.__xor(obsfucated_data, pecb)
         return clean_result
 
     # TODO [Enhancement] Check the seq number
     def _fill_hard_ctx(self, clean_pdu: bytes):
         self.hard_ctx.is_ctrl_msg = ((clean_pdu[0] & 0x80) >> 7) == 1
         self.hard_ctx.ttl = clean_pdu[0] & 0x7f
-        self.hard_ctx.seq = int.from_bytes(clean_pdu[1:4], 'big')
+        self.hard_ctx.seq = _unpack_u32(clean_pdu)[0] & 0xffffff
 
     def _decrypt(self, encrypted_pdu: bytes, src: bytes,
                  net_data: NetworkData, net_mic: bytes) -> (bytes, bool):
@@ -150,8 +215,7 @@ class NetworkLayer:
         ctl = 0x80 if self.hard_ctx.is_ctrl_msg else 0x00
         ttl = self.hard_ctx.ttl
         seq = self.hard_ctx.seq
-        network_nonce = b'\x00' + (ctl | ttl).to_bytes(1, 'big') + \
-            seq.to_bytes(3, 'big') + src + b'\x00\x00' + net_data.iv_index
+        network_nonce = self._gen_net_nonce(ctl, ttl, seq, src, net_data)
 
         decrypted_pdu, mic_is_ok = crypto.aes_ccm_decrypt(
             key=encryption_key, nonce=network_nonce, text=encrypted_pdu,
@@ -173,6 +237,11 @@ class NetworkLayer:
             if msg_type != b'message':
                 continue
 
+            # IVI/NID, obfuscated header, DST, at least one byte of transport
+            # PDU and a 32 bits NetMIC
+            if len(net_pdu) < 14:
+                continue
+
             # get network by nid
             nid = net_pdu[0] & 0x7f
             net_data = self.__search_network_by_nid(nid)
@@ -185,8 +254,14 @@ class NetworkLayer:
             # update seq, is_ctrl_msg
             self._fill_hard_ctx(clean_pdu)
 
-            # decrypting
+            # drop messages from unknown nodes before decrypting them
             src_addr = clean_pdu[-2:]
+            node_filename = self.__search_node_file_by_addr(src_addr)
+            if not node_filename:
+                self.log.debug(f'Node with addr {src_addr} is unknown')
+                continue
+
+            # decrypting
             mic_size = 8 if self.hard_ctx.is_ctrl_msg else 4
             net_mic = net_pdu[-mic_size:]
             encrypted_pdu = net_pdu[7:-mic_size]
@@ -197,12 +272,9 @@ class NetworkLayer:
                 self.log.debug(f'NetMIC wrong. Receive "{net_mic.hex()}"')
                 continue
 
-            # update seq number in node_data YAML file
-            node_data = self.__search_node_by_addr(src_addr)
-            if not node_data:
-                self.log.debug(f'Node with addr {src_addr} is unknown')
-                continue
-
+            # update seq number in node_data YAML file. The node file is
+            # reloaded because its seq changes on every message
+            node_data = NodeData.load(node_filename)
             node_data.seq = self.hard_ctx.seq
             node_data.save()
 
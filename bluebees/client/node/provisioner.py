@@ -2,14 +2,25 @@ from bluebees.common.client import Client
 from dataclasses import dataclass
 from bluebees.common.utils import order, crc8
 from asyncio import wait_for
-from ecdsa import NIST256p, SigningKey
-from ecdsa.ellipticcurve import Point
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding, \
+    PublicFormat
 from bluebees.common.crypto import crypto
-from Crypto.Random import get_random_bytes
 from typing import List
 from bluebees.common.logging import log_sys, INFO, DEBUG
 from tqdm import tqdm
 import asyncio
+import secrets
+
+# auth value for the No OOB authentication method
+_ZERO16 = bytes(16)
+
+_close_reasons = {
+    b'\x00': 'success',
+    b'\x01': 'timeout',
+    b'\x02': 'fail',
+}
 
 
 class LinkOpenError(KeyboardInterrupt):
@@ -30,9 +41,9 @@ class ProvisioningContext:
     client_tr_number: int
     node_tr_number: int
 
-    public_key: Point
-    private_key: int
-    node_public_key: Point
+    public_key: bytes    # X || Y, 64 bytes
+    private_key: ec.EllipticCurvePrivateKey
+    node_public_key: bytes  # X || Y, 64 bytes
     ecdh_secret: bytes
     random_provisioner: bytes
     random_device: bytes
@@ -64,14 +75,14 @@ class GenericProvContext:
     total_length: int
     fcs: int
     current_index: int
-    content: bytes
+    content: bytearray
 
     def reset(self):
         self.segn = 0
         self.total_length = 0
         self.fcs = 0
         self.current_index = 0
-        self.content = b''
+        self.content = bytearray()
 
 
 class Provisioner(Client):
@@ -88,8 +99,10 @@ class Provisioner(Client):
             self.log.set_level(INFO)
 
         self.adv_mtu = 24
-        self.start_pdu = 0
-        self.cont_pdu = 2
+        # indexed by the generic provisioning control format: start, ack,
+        # continuation and bearer control
+        self.__remount_funcs = (self.__remount_start_pdu, None,
+                                self.__remount_cont_pdu, None)
 
         self.loop = loop
         self.device_info = DeviceInfo(uuid=device_uuid,
@@ -116,14 +129,15 @@ class Provisioner(Client):
                                             random_device=None,
                                             node_public_key=None)
         self.g_recv_ctx = GenericProvContext(segn=0, total_length=0, fcs=0,
-                                             current_index=0, content=b'')
+                                             current_index=0,
+                                             content=bytearray())
 
-        sk = SigningKey.generate(curve=NIST256p)
-        vk = sk.get_verifying_key()
-        self.prov_ctx.private_key = sk.privkey.secret_multiplier
-        self.prov_ctx.public_key = vk.pubkey.point
+        sk = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        self.prov_ctx.private_key = sk
+        self.prov_ctx.public_key = sk.public_key().public_bytes(
+            Encoding.X962, PublicFormat.UncompressedPoint)[1:]
 
-        self.prov_ctx.random_provisioner = get_random_bytes(16)
+        self.prov_ctx.random_provisioner = secrets.token_bytes(16)
 
         self.devkey = None
 
@@ -131,14 +145,7 @@ class Provisioner(Client):
 
     # link method
     def __close_reason(self, reason: bytes) -> str:
-        if reason == b'\x00':
-            return 'success'
-        elif reason == b'\x01':
-            return 'timeout'
-        elif reason == b'\x02':
-            return 'fail'
-        else:
-            return 'unknown'
+        return _close_reasons.get(reason, 'unknown')
 
     async def _open_link(self):
         msg_type = b'prov_s'
@@ -178,21 +185,26 @@ class Provisioner(Client):
         adv_header += self.prov_ctx.client_tr_number.to_bytes(1, 'big')
         g_pdus = []
 
+        start_mtu = self.adv_mtu - 4
+        cont_mtu = self.adv_mtu - 1
+
         # start pdu
-        last_index = int((len(content) - 1) / self.adv_mtu)
+        last_index = 0
+        if len(content) > start_mtu:
+            last_index = (len(content) - start_mtu - 1) // cont_mtu + 1
         segn = (last_index << 2).to_bytes(1, 'big')
         total_length = len(content).to_bytes(2, 'big')
         fcs = crc8(content).to_bytes(1, 'big')
-        data = content[0:self.adv_mtu - 4]
+        data = content[0:start_mtu]
         g_pdus.append(adv_header + segn + total_length + fcs + data)
 
         # contiuation pdu
-        content = content[self.adv_mtu - 4:]
-        for x in range(last_index):
-            index = (((x + 1) << 2) | 0x02).to_bytes(1, 'big')
-            data = content[0:self.adv_mtu - 1]
-            g_pdus.append(adv_header + index + data)
-            content = content[self.adv_mtu - 1:]
+        headers = bytes((((x + 1) & 0x3f) << 2) | 0x02
+                        for x in range(last_index))
+        for x, header in enumerate(headers):
+            start = start_mtu + x * cont_mtu
+            data = content[start:start + cont_mtu]
+            g_pdus.append(b''.join((adv_header, bytes((header,)), data)))
 
         return g_pdus
 
@@ -218,11 +230,14 @@ class Provisioner(Client):
     async def _send_pdu(self, tries: int, phase_name: str, total_timeout: int,
                         mount_pdu_func) -> bool:
         timeout = int(total_timeout / tries)
+
+        # the pdu content (and its key derivations) doesn't change between
+        # tries, so mount it only once
+        content = mount_pdu_func()
+        generic_prov_pdus = self.__mount_generic_prov_pdu(content)
+
         for try_ in range(tries):
             self.log.debug(f'Send {phase_name} PDU')
-            content = mount_pdu_func()
-
-            generic_prov_pdus = self.__mount_generic_prov_pdu(content)
 
             for pdu in generic_prov_pdus:
                 await self.messages_to_send.put((b'prov_s', pdu))
@@ -241,6 +256,47 @@ class Provisioner(Client):
         return False
 
     # wait pdu methods
+    def __finish_recv_pdu(self) -> bytes:
+        calc_fcs = crc8(self.g_recv_ctx.content)
+        total_len = len(self.g_recv_ctx.content)
+        if total_len != self.g_recv_ctx.total_length:
+            self.g_recv_ctx.reset()
+            self.log.debug('Wrong total len')
+        elif calc_fcs != self.g_recv_ctx.fcs:
+            self.g_recv_ctx.reset()
+            self.log.debug('Wrong FCS')
+        else:
+            pdu = bytes(self.g_recv_ctx.content)
+            self.g_recv_ctx.reset()
+            return pdu
+
+        return None
+
+    def __remount_start_pdu(self, content) -> bytes:
+        self.g_recv_ctx.reset()
+        self.g_recv_ctx.segn = (content[0] & 0xfc) >> 2
+        self.g_recv_ctx.total_length = int.from_bytes(content[1:3], 'big')
+        self.g_recv_ctx.fcs = content[3]
+        self.g_recv_ctx.current_index = 1
+        self.g_recv_ctx.content = bytearray(content[4:self.adv_mtu])
+
+        if self.g_recv_ctx.segn == 0:
+            return self.__finish_recv_pdu()
+
+        return None
+
+    def __remount_cont_pdu(self, content) -> bytes:
+        index = (content[0] & 0xfc) >> 2
+        if index != self.g_recv_ctx.current_index:
+            return None
+
+        self.g_recv_ctx.content.extend(content[1:self.adv_mtu])
+        if index != self.g_recv_ctx.segn:
+            self.g_recv_ctx.current_index += 1
+            return None
+
+        return self.__finish_recv_pdu()
+
     def __remount_recv_pdu(self, content) -> bytes:
         node_tr_number = self.prov_ctx.node_tr_number.to_bytes(1, 'big')
         expected_adv_header = self.prov_ctx.device_link + node_tr_number
@@ -250,50 +306,11 @@ class Provisioner(Client):
 
         content = content[5:]
 
-        pdu_type = content[0] & 0x03
-        if pdu_type == self.start_pdu:
-            self.g_recv_ctx.reset()
-            self.g_recv_ctx.segn = (content[0] & 0xfc) >> 2
-            self.g_recv_ctx.total_length = int.from_bytes(content[1:3], 'big')
-            self.g_recv_ctx.fcs = content[3]
-            self.g_recv_ctx.current_index = 1
-            self.g_recv_ctx.content = content[4:self.adv_mtu]
-
-            if self.g_recv_ctx.segn == 0:
-                calc_fcs = crc8(self.g_recv_ctx.content)
-                total_len = len(self.g_recv_ctx.content)
-                if total_len != self.g_recv_ctx.total_length:
-                    self.g_recv_ctx.reset()
-                    self.log.debug('Wrong total len')
-                elif calc_fcs != self.g_recv_ctx.fcs:
-                    self.g_recv_ctx.reset()
-                    self.log.debug('Wrong FCS')
-                else:
-                    pdu = self.g_recv_ctx.content
-                    self.g_recv_ctx.reset()
-                    return pdu
-        elif pdu_type == self.cont_pdu:
-            index = (content[0] & 0xfc) >> 2
-            if index == self.g_recv_ctx.current_index:
-                if index != self.g_recv_ctx.segn:
-                    self.g_recv_ctx.current_index += 1
-                    self.g_recv_ctx.content += content[1:self.adv_mtu]
-                else:
-                    self.g_recv_ctx.content += content[1: self.adv_mtu]
-                    calc_fcs = crc8(self.g_recv_ctx.content)
-                    total_len = len(self.g_recv_ctx.content)
-                    if total_len != self.g_recv_ctx.total_length:
-                        self.g_recv_ctx.reset()
-                        self.log.debug('Wrong total len')
-                    elif calc_fcs != self.g_recv_ctx.fcs:
-                        self.g_recv_ctx.reset()
-                        self.log.debug('Wrong FCS')
-                    else:
-                        pdu = self.g_recv_ctx.content
-                        self.g_recv_ctx.reset()
-                        return pdu
+        remount_func = self.__remount_funcs[content[0] & 0x03]
+        if not remount_func:
+            return None
 
-        return None
+        return remount_func(content)
 
     async def __send_ack(self):
         content = self.prov_ctx.device_link
@@ -333,15 +350,14 @@ class Provisioner(Client):
 
             self.prov_ctx.node_tr_number += 1
             return True
-        except TimeoutError:
+        except asyncio.TimeoutError:
             return False
 
     # invite phase
     def _mount_invite_pdu(self) -> bytes:
-        content = b'\x00'
-        content += self.device_info.attention.to_bytes(1, 'big')
+        content = bytes((0x00, self.device_info.attention))
 
-        self.prov_ctx.invite_pdu = self.device_info.attention.to_bytes(1, 'big')
+        self.prov_ctx.invite_pdu = content[1:]
 
         return content
 
@@ -362,20 +378,17 @@ class Provisioner(Client):
 
     # exchanging public key phase
     def _mount_start_pdu(self) -> bytes:
-        content = b'\x02'
-        content += b'\x00\x00\x00\x00\x00'
+        content = b'\x02\x00\x00\x00\x00\x00'
 
-        self.prov_ctx.start_pdu = b'\x00\x00\x00\x00\x00'
+        self.prov_ctx.start_pdu = content[1:]
 
         return content
 
     def _mount_public_key_pdu(self) -> bytes:
-        public_key_x = self.prov_ctx.public_key.x().to_bytes(32, 'big')
-        public_key_y = self.prov_ctx.public_key.y().to_bytes(32, 'big')
+        public_key_x = self.prov_ctx.public_key[0:32]
+        public_key_y = self.prov_ctx.public_key[32:64]
 
-        content = b'\x03'
-        content += public_key_x
-        content += public_key_y
+        content = b'\x03' + self.prov_ctx.public_key
 
         self.log.debug(f'Pub key x {public_key_x.hex()}')
         self.log.debug(f'Pub key y {public_key_y.hex()}')
@@ -383,35 +396,40 @@ class Provisioner(Client):
         return content
 
     def _check_public_key_pdu(self, content) -> bool:
-        self.prov_ctx.node_public_key = Point(curve=NIST256p.curve,
-                                              x=int.from_bytes(content[1:33], 'big'),
-                                              y=int.from_bytes(content[33:65], 'big'))
+        if content[0:1] != b'\x03' or len(content[1:]) != 64:
+            return False
+
+        try:
+            node_public_key = ec.EllipticCurvePublicKey.from_encoded_point(
+                ec.SECP256R1(), b'\x04' + content[1:65])
+        except ValueError:
+            self.log.debug('Invalid node public key')
+            return False
 
-        self.prov_ctx.ecdh_secret = (self.prov_ctx.private_key * self.prov_ctx.node_public_key).x().to_bytes(32, 'big')
+        self.prov_ctx.node_public_key = content[1:65]
+        self.prov_ctx.ecdh_secret = self.prov_ctx.private_key.exchange(
+            ec.ECDH(), node_public_key)
 
-        return content[0:1] == b'\x03' and len(content[1:]) == 64
+        return True
 
     # authentication phase
     def _mount_confirmation_pdu(self) -> bytes:
-        self.prov_ctx.auth_value = bytes(16)
+        self.prov_ctx.auth_value = _ZERO16
 
         confirmation_inputs = self.prov_ctx.invite_pdu
         confirmation_inputs += self.prov_ctx.capabilities_pdu
         confirmation_inputs += self.prov_ctx.start_pdu
-        confirmation_inputs += self.prov_ctx.public_key.x().to_bytes(32, 'big')
-        confirmation_inputs += self.prov_ctx.public_key.y().to_bytes(32, 'big')
-        confirmation_inputs += self.prov_ctx.node_public_key.x().to_bytes(32, 'big')
-        confirmation_inputs += self.prov_ctx.node_public_key.y().to_bytes(32, 'big')
+        confirmation_inputs += self.prov_ctx.public_key
+        confirmation_inputs += self.prov_ctx.node_public_key
 
         self.prov_ctx.confirmation_salt = crypto.s1(text=confirmation_inputs)
         self.prov_ctx.confirmation_key = crypto.k1(n=self.prov_ctx.ecdh_secret,
                                                    salt=self.prov_ctx.confirmation_salt,
                                                    p=b'prck')
 
-        content = b'\x05'
-        content += crypto.aes_cmac(key=self.prov_ctx.confirmation_key,
-                                   text=self.prov_ctx.random_provisioner +
-                                   self.prov_ctx.auth_value)
+        content = b'\x05' + crypto.aes_cmac(key=self.prov_ctx.confirmation_key,
+                                           text=self.prov_ctx.random_provisioner +
+                                           self.prov_ctx.auth_value)
 
         self.log.debug(f'ConfInputs[0]   {confirmation_inputs[0:64].hex()}')
         self.log.debug(f'ConfInputs[64]  {confirmation_inputs[64:128].hex()}')
@@ -428,10 +446,7 @@ class Provisioner(Client):
         return content[0:1] == b'\x05' and len(content[1:]) == 16
 
     def _mount_random_pdu(self) -> bytes:
-        content = b'\x06'
-        content += self.prov_ctx.random_provisioner
-
-        return content
+        return b'\x06' + self.prov_ctx.random_provisioner
 
     def _check_random_pdu(self, content) -> bool:
         self.prov_ctx.random_device = content[1:]
@@ -467,11 +482,7 @@ class Provisioner(Client):
         self.devkey = crypto.k1(n=self.prov_ctx.ecdh_secret, salt=prov_salt,
                                 p=b'prdk')[0:16]
 
-        content = b'\x07'
-        content += encrypted_data
-        content += data_mic
-
-        return content
+        return b''.join((b'\x07', encrypted_data, data_mic))
 
     def _check_complete_pdu(self, content) -> bool:
         return content[0:1] == b'\x08'
@@ -1,6 +1,37 @@
 from Crypto.Cipher import AES
-from Crypto.Hash import CMAC
-from Crypto.Random import get_random_bytes
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers import algorithms
+from cryptography.hazmat.primitives.ciphers.aead import AESCCM
+from cryptography.hazmat.primitives.cmac import CMAC
+from functools import lru_cache
+
+_ZERO16 = bytes(16)
+
+
+@lru_cache(maxsize=64)
+def _ecb_encrypt_for(key: bytes):
+    # bound encrypt of a single ECB cipher, so the key schedule and the
+    # cipher lookup happen once per key
+    return AES.new(key, mode=AES.MODE_ECB).encrypt
+
+
+def _cmac_ctx(key: bytes) -> CMAC:
+    return CMAC(algorithms.AES(key), backend=default_backend())
+
+
+@lru_cache(maxsize=8)
+def _k1_ctx_for(n: bytes, salt: bytes) -> CMAC:
+    # provisioning derives several keys from the same (n, salt), so keep the
+    # CMAC context keyed with the intermediate key T
+    t = _cmac_ctx(salt)
+    t.update(n)
+    return _cmac_ctx(t.finalize())
+
+
+@lru_cache(maxsize=64)
+def _ccm_for(key: bytes, tag_length: int) -> AESCCM:
+    return AESCCM(key, tag_length=tag_length)
 
 
 class Crypto:
@@ -9,42 +40,45 @@ class Crypto:
         pass
 
     def e(self, key: bytes, plaintext: bytes):
-        cipher = AES.new(key, mode=AES.MODE_ECB)
-        msg = cipher.encrypt(plaintext)
+        msg = _ecb_encrypt_for(key)(plaintext)
         return msg[0:6]
 
     def aes_cmac(self, key: bytes, text: bytes):
-        cobj = CMAC.new(key=key, ciphermod=AES)
+        cobj = _cmac_ctx(key)
         cobj.update(text)
-        return cobj.digest()
+        return cobj.finalize()
 
     def aes_ccm(self, key: bytes, nonce: bytes, text: bytes, adata: bytes):
-        cypher = AES.new(key=key, mode=AES.MODE_CCM, nonce=nonce, mac_len=8, assoc_len=len(adata))
-        cyphertext, tag = cypher.encrypt_and_digest(text + adata)
+        cypher = _ccm_for(key, 8)
+        cyphertext = cypher.encrypt(nonce, text, adata or None)
         return cyphertext[0:13]
 
+    def aes_ccm_encrypt(self, key: bytes, nonce: bytes, text: bytes, adata: bytes, mic_size=8):
+        cypher = _ccm_for(key, mic_size)
+        return cypher.encrypt(nonce, text, adata or None)
+
     def aes_ccm_complete(self, key: bytes, nonce: bytes, text: bytes, adata: bytes, mic_size=8):
-        cypher = AES.new(key=key, mode=AES.MODE_CCM, nonce=nonce, mac_len=mic_size, assoc_len=len(adata), msg_len=len(text))
-        cyphertext, tag = cypher.encrypt_and_digest(text + adata)
-        return cyphertext, tag
+        result = self.aes_ccm_encrypt(key, nonce, text, adata, mic_size)
+        return result[:-mic_size], result[-mic_size:]
 
     def aes_ccm_decrypt(self, key: bytes, nonce: bytes, text: bytes, mic: bytes):
-        cypher = AES.new(key=key, mode=AES.MODE_CCM, nonce=nonce, mac_len=len(mic))
-        data = cypher.decrypt(text)
+        cypher = _ccm_for(key, len(mic))
         try:
-            cypher.verify(mic)
-        except ValueError:
+            data = cypher.decrypt(nonce, text + mic, None)
+        except InvalidTag:
+            data = b''
             check = False
         else:
             check = True
         return data, check
 
     def s1(self, text: bytes):
-        return self.aes_cmac(key=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00', text=text)
+        return self.aes_cmac(key=_ZERO16, text=text)
 
     def k1(self, n: bytes, salt: bytes, p: bytes):
-        t = self.aes_cmac(salt, n)
-        return self.aes_cmac(key=t, text=p)
+        cobj = _k1_ctx_for(n, salt).copy()
+        cobj.update(p)
+        return cobj.finalize()
 
     def k2(self, n: bytes, p: bytes):
         salt = self.s1(b'smk2')
@@ -27,6 +27,7 @@ setup(
     include_package_data=True,
     install_requires=[
         "pycryptodome==3.7.3",
+        "cryptography==2.7",
         "termcolor==1.1.0",
         "pyserial==3.4",
         "ecdsa==0.13.3",
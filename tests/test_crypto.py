@@ -127,3 +127,48 @@ def test_aes_ccm_mic_check():
                                            encrypted_pdu, mic)
     assert result == expected_result
     assert check is True
+
+
+def test_aes_ccm_encrypt_net_mic_64():
+    '''Message #1'''
+    dst = bytes.fromhex('fffd')
+    transport_pdu = bytes.fromhex('034b50057e400000010000')
+    network_nonce = bytes.fromhex('00800000011201000012345678')
+    encryption_key = bytes.fromhex('0953fa93e7caac9638f58820220a398e')
+
+    expected_result = bytes.fromhex('b5e5bfdacbaf6cb7fb6bff871f'
+                                    '035444ce83a670df')
+    result = crypto.aes_ccm_encrypt(encryption_key, network_nonce,
+                                    dst + transport_pdu, b'', mic_size=8)
+    assert result == expected_result
+
+
+def test_aes_ccm_encrypt_net_mic_32():
+    '''Message #1 inputs with a 32 bits NetMIC'''
+    dst = bytes.fromhex('fffd')
+    transport_pdu = bytes.fromhex('034b50057e400000010000')
+    network_nonce = bytes.fromhex('00800000011201000012345678')
+    encryption_key = bytes.fromhex('0953fa93e7caac9638f58820220a398e')
+
+    expected_result = bytes.fromhex('b5e5bfdacbaf6cb7fb6bff871f7a95e58d')
+    result = crypto.aes_ccm_encrypt(encryption_key, network_nonce,
+                                    dst + transport_pdu, b'', mic_size=4)
+    assert result == expected_result
+
+    data, check = crypto.aes_ccm_decrypt(encryption_key, network_nonce,
+                                         result[:-4], result[-4:])
+    assert data == dst + transport_pdu
+    assert check is True
+
+
+def test_aes_ccm_mic_check_fail():
+    '''Message #7 with a corrupted NetMIC'''
+    encrypted_pdu = bytes.fromhex('0d0d730f94d7f3509d')
+    network_nonce = bytes.fromhex('008b0148352345000012345678')
+    encryption_key = bytes.fromhex('0953fa93e7caac9638f58820220a398e')
+    mic = bytes.fromhex('f987bb417eb7c05e')
+
+    result, check = crypto.aes_ccm_decrypt(encryption_key, network_nonce,
+                                           encrypted_pdu, mic)
+    assert result == b''
+    assert check is False
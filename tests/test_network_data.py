@@ -1,21 +1,19 @@
 from bluebees.common.file import file_helper
 from bluebees.client.network.network_data import NetworkData
 from bluebees.client.data_paths import base_dir, net_dir
-from Crypto.Random import get_random_bytes
+import os
 import pathlib
 
 
 def test_network_data():
     name = 'test_net'
-    key = get_random_bytes(16)
-    key_index = get_random_bytes(2)
-    iv_index = get_random_bytes(4)
+    key = os.urandom(16)
+    key_index = os.urandom(2)
+    iv_index = os.urandom(4)
     num_apps = 10
     num_nodes = 15
 
-    apps = []
-    for x in range(num_apps):
-        apps.append(f'test_app{x}')
+    apps = [f'test_app{x}' for x in range(num_apps)]
 
     nodes = []
     for x in range(num_nodes):
@@ -0,0 +1,36 @@
+from bluebees.client.mesh_layers.network_layer import NetworkLayer
+from bluebees.client.network.network_data import NetworkData
+import pytest
+
+
+def test_net_nonce():
+    '''Message #1'''
+    net_layer = NetworkLayer(send_queue=None, recv_queue=None)
+    net_data = NetworkData(name='test_net', key=bytes(16),
+                           key_index=b'\x00\x00',
+                           iv_index=bytes.fromhex('12345678'))
+
+    expected = bytes.fromhex('00800000011201000012345678')
+    nonce = net_layer._gen_net_nonce(ctl=0x80, ttl=0x00, seq=0x000001,
+                                     src=bytes.fromhex('1201'),
+                                     net_data=net_data)
+
+    assert nonce == expected
+
+
+def test_net_nonce_seq_boundary():
+    net_layer = NetworkLayer(send_queue=None, recv_queue=None)
+    net_data = NetworkData(name='test_net', key=bytes(16),
+                           key_index=b'\x00\x00',
+                           iv_index=bytes.fromhex('12345678'))
+    src = bytes.fromhex('1201')
+
+    nonce = net_layer._gen_net_nonce(0x80, 0x02, 0xffffff, src, net_data)
+    assert nonce[2:5] == b'\xff\xff\xff'
+
+    with pytest.raises(OverflowError):
+        net_layer._gen_net_nonce(0x80, 0x02, 0x1000000, src, net_data)
+
+    net_layer.hard_ctx.seq = 0x1000005
+    with pytest.raises(OverflowError):
+        net_layer._decrypt(bytes(9), src, net_data, bytes(8))
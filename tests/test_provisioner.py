@@ -0,0 +1,39 @@
+from bluebees.client.node.provisioner import Provisioner
+import pytest
+import os
+
+
+@pytest.fixture
+def provisioner():
+    prov = Provisioner(loop=None, device_uuid=bytes(16), netkey=bytes(16),
+                       key_index=b'\x00\x00', iv_index=bytes(4),
+                       address=b'\x00\x01')
+    # segments are mounted and remounted by the same side in this test
+    prov.prov_ctx.client_tr_number = prov.prov_ctx.node_tr_number
+
+    yield prov
+
+    for task in prov.client_tasks + prov.all_tasks:
+        task.close()
+    prov.pub_sock.close()
+    prov.sub_sock.close()
+
+
+@pytest.mark.parametrize('length, segn', [(1, 0), (20, 0), (21, 1), (43, 1),
+                                          (44, 2), (66, 2), (67, 3)])
+def test_generic_prov_segmentation(provisioner, length, segn):
+    content = os.urandom(length)
+
+    g_pdus = provisioner._Provisioner__mount_generic_prov_pdu(content)
+
+    assert len(g_pdus) == segn + 1
+    assert g_pdus[0][5] >> 2 == segn
+    assert int.from_bytes(g_pdus[0][6:8], 'big') == length
+    for index, g_pdu in enumerate(g_pdus[1:], 1):
+        assert g_pdu[5] == (index << 2) | 0x02
+
+    remounted = [provisioner._Provisioner__remount_recv_pdu(g_pdu)
+                 for g_pdu in g_pdus]
+
+    assert remounted[:-1] == [None] * segn
+    assert remounted[-1] == content